@@ -1,29 +1,66 @@
-import json
-import uvicorn
+import asyncio
+import logging
+import logging.handlers
+import pickle
+import orjson
+from contextlib import aclosing
+from queue import SimpleQueue
 from typing import TypedDict, Annotated, Optional
 from uuid import uuid4
 
 from langgraph.graph import add_messages, StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, ToolMessage, SystemMessage
+from langchain_core.messages import AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from dotenv import load_dotenv 
 
 from fastapi import FastAPI, Query
-from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware  
+from sse_starlette.sse import EventSourceResponse
 
 
 # Import database setup and tools from sql.py
-from sql import setup_database, list_tables_tool, query_sql_tool, tools
+from sql import setup_database, list_table_names, tools, TOOL_REGISTRY
 
 # Load API keys from .env file
 load_dotenv()
 
+# Log records are handed to a queue and written to stderr by a listener thread,
+# so logging from the request path never blocks on the console. The queue handler
+# is only attached while the listener runs (see on_startup), so the queue is
+# always being drained.
+log_queue = SimpleQueue()
+log_handler = logging.handlers.QueueHandler(log_queue)
+log_console = logging.StreamHandler()
+log_console.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_console)
+
+# Only this app's loggers log at INFO; libraries such as httpx keep their defaults
+logger = logging.getLogger(__name__)
+for name in (__name__, "sql"):
+    logging.getLogger(name).setLevel(logging.INFO)
+
 # --- LangGraph Agent Setup ---
 
+class PickleSerializer(JsonPlusSerializer):
+    """
+    Checkpoint serializer using pickle protocol 5, which encodes the message
+    history faster than the default serializer. MemorySaver keeps checkpoints
+    inside this process, so nothing is ever unpickled from an outside source.
+    """
+    def dumps_typed(self, obj):
+        return "pickle", pickle.dumps(obj, protocol=5)
+
+    def loads_typed(self, data):
+        type_, payload = data
+        if type_ == "pickle":
+            return pickle.loads(payload)
+        return super().loads_typed(data)
+
 # Initialize memory saver
-memory = MemorySaver()
+memory = MemorySaver(serde=PickleSerializer())
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
@@ -32,49 +69,73 @@ class State(TypedDict):
 llm = ChatOpenAI(model="gpt-4o")
 llm_with_tools = llm.bind_tools(tools=tools)
 
+# System prompt to guide the LLM
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant that interacts with a SQL database. "
+    "The database is named 'company.db' and contains a table named 'Employees'. "
+    "The 'Employees' table has the following columns: id (INTEGER, PRIMARY KEY), Name (TEXT), Age (INTEGER), "
+    "Department (TEXT), Salary (REAL), Mobile (TEXT), Email (TEXT). "
+    "Given a user's question, you must first decide if you need to query the database. "
+    "If you need to query, you can use `sql_db_list_tables` to see tables, and then `sql_db_query` to get the answer. "
+    "You must generate the SQL query yourself. Only query the columns necessary to answer the question. "
+    "After you receive the SQL result, you must answer the user's original question in plain, natural language. "
+    "If the question is not about the database, answer it as a general AI assistant."
+)
+
+# The system prompt is added on every model call instead of being stored in the
+# conversation state, so it is not written into every checkpoint
+prompt = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    MessagesPlaceholder("messages")
+])
+chain = prompt | llm_with_tools
+
 # Define the agent nodes
 async def model(state: State):
     """LLM node."""
-    result = await llm_with_tools.ainvoke(state["messages"])
+    result = await chain.ainvoke({"messages": state["messages"]})
     return {"messages": [result]}
 
 async def tools_router(state: State):
     """Router node to check for tool calls."""
-    last_message = state["messages"][-1]
-    if hasattr(last_message, "tool_calls") and len(last_message.tool_calls) > 0:
+    if getattr(state["messages"][-1], "tool_calls", None):
         return "tool_node"
     else: 
         return END
     
+async def run_tool_call(tool_call):
+    """Executes a single tool call and wraps the result in a ToolMessage."""
+    tool_name = tool_call["name"]
+    tool_args = tool_call["args"]
+    tool_id = tool_call["id"]
+    
+    logger.info("Executing tool %s with args %s", tool_name, tool_args)
+    
+    try:
+        if tool_name == "sql_db_list_tables":
+            # The schema is static, so answer from the cache warmed at startup
+            result = list_table_names()
+        elif tool_name in TOOL_REGISTRY:
+            # The SQL tools are sync, so ainvoke runs them in a worker thread
+            # and the event loop stays free
+            result = await TOOL_REGISTRY[tool_name].ainvoke(tool_args)
+        else:
+            result = f"Error: Unknown tool {tool_name}"
+    except Exception as e:
+        logger.error("Error executing tool %s: %s", tool_name, e)
+        result = f"Error executing tool: {str(e)}"
+
+    return ToolMessage(
+        content=str(result),
+        tool_call_id=tool_id,
+        name=tool_name
+    )
+
 async def tool_node(state):
-    """Custom tool node that handles the SQL tool calls."""
+    """Custom tool node that runs the SQL tool calls concurrently."""
     tool_calls = state["messages"][-1].tool_calls
-    tool_messages = []
-    
-    for tool_call in tool_calls:
-        tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-        tool_id = tool_call["id"]
-        
-        print(f"--- Executing Tool: {tool_name} with args {tool_args} ---")
-        
-        try:
-            # We use the imported tool variables here
-            if tool_name == "sql_db_list_tables":
-                result = await list_tables_tool.ainvoke({}) 
-            elif tool_name == "sql_db_query":
-                result = await query_sql_tool.ainvoke(tool_args)
-            else:
-                result = f"Error: Unknown tool {tool_name}"
-        except Exception as e:
-            print(f"Error executing tool {tool_name}: {e}")
-            result = f"Error executing tool: {str(e)}"
-
-        tool_messages.append(ToolMessage(
-            content=str(result),
-            tool_call_id=tool_id,
-            name=tool_name
-        ))
+    # gather keeps the results in the same order as the tool calls
+    tool_messages = await asyncio.gather(*(run_tool_call(tool_call) for tool_call in tool_calls))
     
     return {"messages": tool_messages}
 
@@ -100,18 +161,37 @@ app.add_middleware(
     allow_headers=["*"], 
 )
 
-# System prompt to guide the LLM
-SYSTEM_PROMPT = (
-    "You are a helpful AI assistant that interacts with a SQL database. "
-    "The database is named 'company.db' and contains a table named 'Employees'. "
-    "The 'Employees' table has the following columns: id (INTEGER, PRIMARY KEY), Name (TEXT), Age (INTEGER), "
-    "Department (TEXT), Salary (REAL), Mobile (TEXT), Email (TEXT). "
-    "Given a user's question, you must first decide if you need to query the database. "
-    "If you need to query, you can use `sql_db_list_tables` to see tables, and then `sql_db_query` to get the answer. "
-    "You must generate the SQL query yourself. Only query the columns necessary to answer the question. "
-    "After you receive the SQL result, you must answer the user's original question in plain, natural language. "
-    "If the question is not about the database, answer it as a general AI assistant."
-)
+@app.on_event("startup")
+async def on_startup():
+    """Create and populate the database and cache its table list when each worker starts."""
+    log_listener.start()
+    logging.getLogger().addHandler(log_handler)
+    await asyncio.to_thread(setup_database)
+    await asyncio.to_thread(list_table_names)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Flush any queued log records before the worker exits."""
+    logging.getLogger().removeHandler(log_handler)
+    log_listener.stop()
+
+def thread_config(thread_id: str):
+    """Builds the LangGraph config for a conversation thread."""
+    return {"configurable": {"thread_id": thread_id}}
+
+# Maximum number of SSE events buffered between the graph and a slow client
+STREAM_QUEUE_SIZE = 128
+
+# Constant parts of every SSE data frame
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+def sse_event(payload: dict) -> bytes:
+    """
+    Serializes a payload into a complete SSE data frame.
+    EventSourceResponse sends bytes as-is, so no str/encode round trip is needed.
+    """
+    return SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
 
 async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = None):
     """
@@ -121,106 +201,105 @@ async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = N
     
     if is_new_conversation:
         new_checkpoint_id = str(uuid4())
-        config = {"configurable": {"thread_id": new_checkpoint_id}}
+        config = thread_config(new_checkpoint_id)
         
         # Send the new checkpoint ID first
-        yield f"data: {json.dumps({'type': 'checkpoint', 'checkpoint_id': new_checkpoint_id})}\n\n"
-        
-        # Prepare input with system prompt
-        input_messages = [
-            SystemMessage(content=SYSTEM_PROMPT),
-            HumanMessage(content=message)
-        ]
+        yield sse_event({"type": "checkpoint", "checkpoint_id": new_checkpoint_id})
     else:
-        config = {"configurable": {"thread_id": checkpoint_id}}
-        input_messages = [HumanMessage(content=message)]
+        config = thread_config(checkpoint_id)
+
+    # The system prompt is supplied by the model node, so only the user's message is added
+    input_messages = [HumanMessage(content=message)]
 
-    # Start streaming events from the graph
-    events = graph.astream_events(
+    # Stream only LLM tokens ("messages") and node outputs ("updates") from the graph.
+    # durability="exit" writes the checkpoint once when the turn finishes
+    # instead of after every super-step. aclosing makes sure the graph run is
+    # closed if this generator is closed early.
+    stream = graph.astream(
         {"messages": input_messages},
-        version="v2",
-        config=config
+        config=config,
+        stream_mode=["messages", "updates"],
+        durability="exit"
     )
 
-    async for event in events:
-        event_type = event["event"]
-        
-        if event_type == "on_chat_model_stream":
-            chunk = event["data"]["chunk"]
-            if chunk.content:
+    async with aclosing(stream):
+        async for mode, data in stream:
+            if mode == "messages":
+                chunk, _ = data
+                # Tool-call deltas have no text and tool_node's tool messages are not
+                # LLM tokens, so skip both before doing any work
+                if not chunk.content or not isinstance(chunk, AIMessageChunk):
+                    continue
+
                 # Stream content chunks
-                yield f"data: {json.dumps({'type': 'content', 'content': chunk.content})}\n\n"
+                yield sse_event({"type": "content", "content": chunk.content})
                 
-        elif event_type == "on_chat_model_end":
-            # Check if a SQL query tool call was made
-            tool_calls = event["data"]["output"].tool_calls if hasattr(event["data"]["output"], "tool_calls") else []
-            sql_query_calls = [call for call in tool_calls if call["name"] == "sql_db_query"]
+            elif mode == "updates":
+                # Node outputs, keyed by node name
+                if "model" in data:
+                    # Check if a SQL query tool call was made
+                    tool_calls = getattr(data["model"]["messages"][-1], "tool_calls", ())
+                    sql_call = next((call for call in tool_calls if call["name"] == "sql_db_query"), None)
             
-            if sql_query_calls:
-                sql_query = sql_query_calls[0]["args"].get("query", "")
-                yield f"data: {json.dumps({'type': 'sql_query_start', 'query': sql_query})}\n\n"
+                    if sql_call:
+                        sql_query = sql_call["args"].get("query", "")
+                        yield sse_event({"type": "sql_query_start", "query": sql_query})
                 
-        elif event_type == "on_tool_end":
-            # Send SQL query results back to the client
-            if event["name"] == "sql_db_query":
-                output = event["data"]["output"]
-                yield f"data: {json.dumps({'type': 'sql_query_result', 'result': output})}\n\n"
+                elif "tool_node" in data:
+                    # Send SQL query results back to the client
+                    for tool_message in data["tool_node"]["messages"]:
+                        if tool_message.name == "sql_db_query":
+                            yield sse_event({"type": "sql_query_result", "result": tool_message.content})
 
     # Send an end event when the stream is finished
-    yield f"data: {json.dumps({'type': 'end'})}\n\n"
+    yield sse_event({"type": "end"})
+
+async def stream_with_backpressure(events):
+    """
+    Relays events through a bounded queue filled by a separate producer task.
+    A slow client makes the producer wait instead of buffering without limit.
+    EventSourceResponse cancels this generator when the client disconnects,
+    which in turn cancels the producer.
+    """
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    async def produce():
+        # aclosing closes the event generator, and with it the graph run, even
+        # when the producer is cancelled while waiting for room in the queue
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    await queue.put(event)
+        except Exception as e:
+            # Hand the error to the consumer so it is raised in the response
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            if isinstance(event, Exception):
+                raise event
+            yield event
+            await asyncio.sleep(0)
+    finally:
+        # Cancelling the producer closes the graph run and its OpenAI request
+        producer.cancel()
 
 @app.get("/chat_stream/{message}")
 async def chat_stream(message: str, checkpoint_id: Optional[str] = Query(None)):
     """
     FastAPI endpoint to handle streaming chat responses.
     """
-    return StreamingResponse(
-        generate_chat_responses(message, checkpoint_id), 
-        media_type="text/event-stream"
+    # EventSourceResponse handles framing, keepalive pings and the
+    # no-cache / no-buffering headers proxies need to pass the stream through.
+    # Content-Encoding: identity stops compression middleware from buffering it.
+    return EventSourceResponse(
+        stream_with_backpressure(generate_chat_responses(message, checkpoint_id)),
+        ping=15,
+        headers={"Content-Encoding": "identity"}
     )
-
-# Run the app
-if __name__ == "__main__":
-    setup_database() # Create and populate the database on startup
-
-    uvicorn.run(app, host="127.0.0.1", port=8000)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -1,53 +1,101 @@
+import logging
 import sqlite3
+from functools import lru_cache
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.pool import QueuePool
 from langchain_community.utilities import SQLDatabase
 from langchain_community.tools import QuerySQLDataBaseTool, ListSQLDatabaseTool
 
+logger = logging.getLogger(__name__)
+
+# Per-connection pragmas applied to every SQLite connection we open.
+# journal_mode=WAL is stored in the database file itself, so it is only set once in setup_database().
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+def apply_pragmas(conn):
+    """Applies SQLITE_PRAGMAS to a raw sqlite3 connection."""
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+
 def setup_database():
     """
     Creates a SQLite database and an 'Employees' table, 
     then populates it with sample data if it's empty.
     """
-    conn = sqlite3.connect("company.db")
-    cursor = conn.cursor()
+    # isolation_level=None so the transaction below is controlled explicitly
+    conn = sqlite3.connect("company.db", isolation_level=None)
+    try:
+        # WAL lets readers keep going while a writer holds the lock
+        conn.execute("PRAGMA journal_mode=WAL;")
+        apply_pragmas(conn)
+        conn.execute("PRAGMA cache_size=-64000;")
+        cursor = conn.cursor()
+        
+        # Take the write lock up front so workers starting at the same time run
+        # setup one after another and only the first one inserts the sample data
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Create the table
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Employees (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                Name TEXT NOT NULL,
+                Age INTEGER,
+                Department TEXT,
+                Salary REAL,
+                Mobile TEXT,
+                Email TEXT
+            );
+            """)
     
-    # Create the table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS Employees (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        Name TEXT NOT NULL,
-        Age INTEGER,
-        Department TEXT,
-        Salary REAL,
-        Mobile TEXT,
-        Email TEXT
-    );
-    """)
-    
-    # Check if table is empty before inserting
-    cursor.execute("SELECT COUNT(*) FROM Employees")
-    if cursor.fetchone()[0] == 0:
-        print("Populating database with sample data...")
-        sample_data = [
-            ('Alice Smith', 30, 'Engineering', 90000, '555-0101', 'alice@example.com'),
-            ('Bob Johnson', 45, 'Sales', 75000, '555-0102', 'bob@example.com'),
-            ('Charlie Lee', 28, 'Marketing', 68000, '555-0103', 'charlie@example.com'),
-            ('David Brown', 52, 'Engineering', 120000, '555-0104', 'david@example.com'),
-            ('Eve Davis', 35, 'Sales', 82000, '555-0105', 'eve@example.com'),
-            ('Frank White', 41, 'HR', 72000, '555-0106', 'frank@example.com'),
-        ]
-        cursor.executemany(
-            "INSERT INTO Employees (Name, Age, Department, Salary, Mobile, Email) VALUES (?, ?, ?, ?, ?, ?)", 
-            sample_data
-        )
-    
-    conn.commit()
-    conn.close()
-    print("Database 'company.db' is ready.")
+            # Check if table is empty before inserting
+            cursor.execute("SELECT COUNT(*) FROM Employees")
+            if cursor.fetchone()[0] == 0:
+                logger.info("Populating database with sample data...")
+                sample_data = [
+                    ('Alice Smith', 30, 'Engineering', 90000, '555-0101', 'alice@example.com'),
+                    ('Bob Johnson', 45, 'Sales', 75000, '555-0102', 'bob@example.com'),
+                    ('Charlie Lee', 28, 'Marketing', 68000, '555-0103', 'charlie@example.com'),
+                    ('David Brown', 52, 'Engineering', 120000, '555-0104', 'david@example.com'),
+                    ('Eve Davis', 35, 'Sales', 82000, '555-0105', 'eve@example.com'),
+                    ('Frank White', 41, 'HR', 72000, '555-0106', 'frank@example.com'),
+                ]
+                cursor.executemany(
+                    "INSERT INTO Employees (Name, Age, Department, Salary, Mobile, Email) VALUES (?, ?, ?, ?, ?, ?)", 
+                    sample_data
+                )
+            
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    logger.info("Database 'company.db' is ready.")
 
 # --- Tool Creation ---
 
-# Initialize the SQL Database connection
-db = SQLDatabase.from_uri("sqlite:///company.db")
+# Initialize the SQL Database connection with a pooled engine shared by all tools.
+# Each worker process gets its own pool; connections are reused across tool calls
+# and can move between the threads that run the sync SQL tools.
+engine = create_engine(
+    "sqlite:///company.db",
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=10,
+    max_overflow=20,
+)
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    """Applies the per-connection pragmas to each new pooled connection."""
+    apply_pragmas(dbapi_connection)
+
+db = SQLDatabase(engine=engine)
 
 # Initialize the SQL tools
 list_tables_tool = ListSQLDatabaseTool(db=db)
@@ -57,6 +105,17 @@ query_sql_tool = QuerySQLDataBaseTool(db=db)
 
 tools = [list_tables_tool, query_sql_tool]
 
+# Tools by name, used by the agent to dispatch tool calls
+TOOL_REGISTRY = {tool.name: tool for tool in tools}
+
+@lru_cache(maxsize=None)
+def list_table_names():
+    """
+    Returns the table names in the same format as `sql_db_list_tables`.
+    The schema is fixed once setup_database() has run, so it is read only once.
+    """
+    return ", ".join(sorted(inspect(engine).get_table_names()))
+
 
 
 